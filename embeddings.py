@@ -0,0 +1,32 @@
+import onnxruntime
+import torch
+from sentence_transformers import SentenceTransformer
+
+# Configuration
+EMBEDDING_MODEL_NAME = "BAAI/bge-base-en-v1.5"
+EMBEDDING_DIMENSION = 768  # Output size of EMBEDDING_MODEL_NAME
+
+def load_embedding_model(device=None, num_threads=None):
+    """Load the embedding model, by default on the fastest available device.
+
+    num_threads caps the CPU inference threads; by default all cores are used.
+    """
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    if device.startswith("cuda"):
+        # FP16 on GPU halves memory traffic and uses tensor cores
+        model = SentenceTransformer(EMBEDDING_MODEL_NAME, device=device)
+        model.half()
+        return model
+
+    model_kwargs = {}
+    if num_threads:
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = num_threads
+        model_kwargs["session_options"] = session_options
+
+    # ONNX Runtime's fused kernels are faster than PyTorch eager mode on CPU
+    return SentenceTransformer(
+        EMBEDDING_MODEL_NAME, device=device, backend="onnx", model_kwargs=model_kwargs
+    )
@@ -1,14 +1,20 @@
 import os
 import io
 import json
-import hashlib
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
 from typing import Dict, Any, List
+import xxhash
 from minio import Minio
 from qdrant_client import QdrantClient
-from qdrant_client.models import PointStruct, VectorParams, Distance
-from sentence_transformers import SentenceTransformer
-from PyPDF2 import PdfReader
+from qdrant_client.models import (
+    PointStruct, VectorParams, Distance, OptimizersConfigDiff,
+    ScalarQuantization, ScalarQuantizationConfig, ScalarType
+)
+import torch
+import pypdfium2 as pdfium
+from embeddings import EMBEDDING_DIMENSION, load_embedding_model
 
 # Configuration
 MINIO_URL = "localhost:9000"
@@ -16,29 +22,69 @@ MINIO_ACCESS_KEY = "minioadmin"
 MINIO_SECRET_KEY = "minio123"
 BUCKET_NAME = "index"
 COLLECTION_NAME = "documents"
-CHUNK_SIZE = 500  # Characters per chunk
+META_COLLECTION_NAME = "document_meta"  # One point per document holding its metadata
+INDEX_VERSION_POINT_ID = 0  # Point in META_COLLECTION_NAME recording the last index run
+CHUNK_SIZE = 256  # Tokens per chunk
+CHUNK_OVERLAP = 32  # Tokens shared between consecutive chunks
+EMBEDDING_BATCH_SIZE = 64  # Chunks per forward pass of the embedding model
+UPLOAD_BATCH_SIZE = 256  # Points per upload request to Qdrant
+INDEXING_THRESHOLD = 20000  # HNSW indexing threshold restored after bulk load
+FILE_WORKERS = max(1, (os.cpu_count() or 1) // 2)  # Processes indexing files concurrently (capped at one per GPU)
+DOWNLOAD_BLOCK_SIZE = 1 << 20  # Bytes read per step when downloading files
 PROCESSED_FILES_PATH = "processed_files.json"
 FORCE_REINDEX = True  # Set to True to force reindexing all documents
 
-# Initialize clients
-minio_client = Minio(
-    MINIO_URL,
-    access_key=MINIO_ACCESS_KEY,
-    secret_key=MINIO_SECRET_KEY,
-    secure=False
-)
+# Clients and model are created lazily so each worker process builds its own
+minio_client = None
+qdrant_client = None
+embedding_model = None
 
-qdrant_client = QdrantClient("localhost", port=6333)
+def init_clients():
+    """Initialize the MinIO and Qdrant clients."""
+    global minio_client, qdrant_client
+    
+    if minio_client is None:
+        minio_client = Minio(
+            MINIO_URL,
+            access_key=MINIO_ACCESS_KEY,
+            secret_key=MINIO_SECRET_KEY,
+            secure=False
+        )
+    
+    if qdrant_client is None:
+        qdrant_client = QdrantClient("localhost", port=6333, grpc_port=6334, prefer_grpc=True)
 
-# Load embedding model
-embedding_model = SentenceTransformer("BAAI/bge-base-en-v1.5")
+def init_index_worker(device_queue=None, num_threads=None):
+    """Prepare a worker process for indexing files.
+    
+    When GPUs are used, each worker takes its own device from device_queue.
+    num_threads caps the worker's CPU threads so workers don't oversubscribe
+    the machine.
+    """
+    global embedding_model
+    init_clients()
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    device = device_queue.get() if device_queue is not None else None
+    embedding_model = load_embedding_model(device, num_threads)
 
-def get_file_hash(file_stream):
-    """Generate hash for file to detect changes."""
-    file_stream.seek(0)
-    file_hash = hashlib.md5(file_stream.read()).hexdigest()
+def download_file(file_name):
+    """Download a file from MinIO, hashing it as it streams in.
+    
+    Returns the file contents as a stream and the hash used to detect changes.
+    """
+    file_stream = io.BytesIO()
+    hasher = xxhash.xxh3_128()
+    response = minio_client.get_object(BUCKET_NAME, file_name)
+    try:
+        for block in response.stream(DOWNLOAD_BLOCK_SIZE):
+            hasher.update(block)
+            file_stream.write(block)
+    finally:
+        response.close()
+        response.release_conn()
     file_stream.seek(0)
-    return file_hash
+    return file_stream, hasher.hexdigest()
 
 def load_processed_files():
     """Load record of processed files."""
@@ -48,71 +94,141 @@ def load_processed_files():
     return {}
 
 def save_processed_files(processed_files):
-    """Save record of processed files."""
-    with open(PROCESSED_FILES_PATH, 'w') as f:
+    """Save record of processed files atomically."""
+    tmp_path = PROCESSED_FILES_PATH + ".tmp"
+    with open(tmp_path, 'w') as f:
         json.dump(processed_files, f)
+    os.replace(tmp_path, PROCESSED_FILES_PATH)
 
 def extract_text_from_pdf(file_stream):
     """Extract text from PDF file."""
-    reader = PdfReader(file_stream)
-    text = ""
-    
-    print(f"PDF has {len(reader.pages)} pages")
+    pdf = pdfium.PdfDocument(file_stream.getvalue())
+    try:
+        page_count = len(pdf)
+        
+        print(f"PDF has {page_count} pages")
+        
+        page_texts = [pdf[i].get_textpage().get_text_range() for i in range(page_count)]
+    finally:
+        pdf.close()
     
-    for i, page in enumerate(reader.pages):
-        page_text = page.extract_text()
+    parts = []
+    for i, page_text in enumerate(page_texts):
         if page_text:
-            text += page_text + " "
+            parts.append(page_text)
         else:
             print(f"Warning: Page {i+1} returned no text")
     
+    # Join once rather than growing a string page by page
+    text = " ".join(parts).strip()
     print(f"Extracted {len(text)} characters from PDF")
-    return text.strip(), len(reader.pages)
+    return text, page_count
 
-def split_text_into_chunks(text, chunk_size=CHUNK_SIZE):
-    """Split text into chunks of approximately equal size."""
+def split_text_into_chunks(text, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    """Split text into overlapping chunks of approximately equal token count."""
     if not text:
         print("Warning: No text to chunk")
         return []
-        
+    
+    # Tokenize once and map token windows back to character spans of the text
+    encoding = embedding_model.tokenizer(
+        text,
+        add_special_tokens=False,
+        return_offsets_mapping=True,
+        verbose=False
+    )
+    offsets = encoding["offset_mapping"]
+    
     chunks = []
-    for i in range(0, len(text), chunk_size):
-        chunks.append(text[i:i + chunk_size])
+    step = chunk_size - chunk_overlap
+    for i in range(0, len(offsets), step):
+        window = offsets[i:i + chunk_size]
+        chunks.append(text[window[0][0]:window[-1][1]])
+        if i + chunk_size >= len(offsets):
+            break
     
     print(f"Split text into {len(chunks)} chunks")
     return chunks
 
+def create_collection():
+    """Create the Qdrant collection with INT8-quantized vectors."""
+    qdrant_client.create_collection(
+        collection_name=COLLECTION_NAME,
+        vectors_config=VectorParams(size=EMBEDDING_DIMENSION, distance=Distance.DOT),
+        # Defer HNSW indexing until the bulk load has finished
+        optimizers_config=OptimizersConfigDiff(indexing_threshold=0),
+        # Keep INT8 copies in RAM for search; originals are used for rescoring
+        quantization_config=ScalarQuantization(
+            scalar=ScalarQuantizationConfig(
+                type=ScalarType.INT8,
+                quantile=0.99,
+                always_ram=True
+            )
+        )
+    )
+
+def create_meta_collection():
+    """Create the payload-only collection holding per-document metadata."""
+    qdrant_client.create_collection(
+        collection_name=META_COLLECTION_NAME,
+        vectors_config={}
+    )
+
 def reset_collection():
-    """Delete and recreate the collection."""
+    """Delete and recreate the chunk and metadata collections."""
     try:
         collections = qdrant_client.get_collections().collections
         collection_names = [collection.name for collection in collections]
         
-        if COLLECTION_NAME in collection_names:
-            print(f"Deleting existing collection '{COLLECTION_NAME}'")
-            qdrant_client.delete_collection(collection_name=COLLECTION_NAME)
+        for name in (COLLECTION_NAME, META_COLLECTION_NAME):
+            if name in collection_names:
+                print(f"Deleting existing collection '{name}'")
+                qdrant_client.delete_collection(collection_name=name)
         
-        vector_size = embedding_model.get_sentence_embedding_dimension()
-        qdrant_client.create_collection(
-            collection_name=COLLECTION_NAME,
-            vectors_config=VectorParams(size=vector_size, distance=Distance.COSINE)
-        )
+        create_collection()
         print(f"Created fresh collection '{COLLECTION_NAME}'")
+        create_meta_collection()
+        print(f"Created fresh collection '{META_COLLECTION_NAME}'")
     except Exception as e:
         print(f"Error resetting collection: {str(e)}")
 
 def ensure_collection_exists():
-    """Create Qdrant collection if it doesn't exist."""
+    """Create Qdrant collections if they don't exist."""
     collections = qdrant_client.get_collections().collections
     collection_names = [collection.name for collection in collections]
     
     if COLLECTION_NAME not in collection_names:
-        vector_size = embedding_model.get_sentence_embedding_dimension()
-        qdrant_client.create_collection(
+        create_collection()
+        print(f"Created collection '{COLLECTION_NAME}'")
+    
+    if META_COLLECTION_NAME not in collection_names:
+        create_meta_collection()
+        print(f"Created collection '{META_COLLECTION_NAME}'")
+
+def enable_indexing():
+    """Restore the HNSW indexing threshold after a bulk load."""
+    try:
+        qdrant_client.update_collection(
             collection_name=COLLECTION_NAME,
-            vectors_config=VectorParams(size=vector_size, distance=Distance.COSINE)
+            optimizer_config=OptimizersConfigDiff(indexing_threshold=INDEXING_THRESHOLD)
         )
-        print(f"Created collection '{COLLECTION_NAME}'")
+        print(f"Enabled indexing for collection '{COLLECTION_NAME}'")
+    except Exception as e:
+        print(f"Error enabling indexing: {str(e)}")
+
+def update_index_version():
+    """Record a new index version so the retriever drops cached results."""
+    try:
+        qdrant_client.upsert(
+            collection_name=META_COLLECTION_NAME,
+            points=[PointStruct(
+                id=INDEX_VERSION_POINT_ID,
+                vector={},
+                payload={"index_version": time.time()}
+            )]
+        )
+    except Exception as e:
+        print(f"Error updating index version: {str(e)}")
 
 def check_collection_status():
     """Check and print the status of the collection."""
@@ -126,24 +242,57 @@ def check_collection_status():
     except Exception as e:
         print(f"Error checking collection status: {str(e)}")
 
-def index_document(file_name):
-    """Process a single document from MinIO."""
+def get_doc_id(file_name):
+    """Generate the ID of a document's point in the metadata collection."""
+    # Also stored in chunk payloads, where gRPC integers are signed 64-bit
+    return xxhash.xxh3_64_intdigest(file_name.encode()) & 0x7FFF_FFFF_FFFF_FFFF
+
+def get_chunk_id(file_name, chunk_index):
+    """Generate the ID of a chunk's point."""
+    return xxhash.xxh3_64_intdigest(f"{file_name}\x00{chunk_index}".encode())
+
+def generate_payloads(file_name, text_chunks):
+    """Lazily build the payloads of a document's chunk points."""
+    doc_id = get_doc_id(file_name)
+    for i, chunk in enumerate(text_chunks):
+        # Document-level fields live once in the metadata collection
+        yield {
+            "text": chunk,
+            "doc_id": doc_id,
+            "chunk_index": i
+        }
+
+def index_document(file_name, etag, previous_record=None):
+    """Process a single document from MinIO.
+    
+    etag is the object's etag from the bucket listing. previous_record is the
+    document's entry from the processed files record, if any; both are used
+    to skip unchanged files.
+    
+    Returns the updated processed-files record for the document, or None if
+    there is nothing to record (skipped by etag, unsupported, or failed).
+    """
     try:
         print(f"\nProcessing file: {file_name}")
+        previous_record = previous_record or {}
+        
+        # Compare the server-side etag before downloading the file
+        etag = etag.strip('"')
+        
+        if not FORCE_REINDEX and previous_record.get("etag") == etag:
+            print(f"File {file_name} already indexed and unchanged (etag). Skipping.")
+            return None
         
         # Get file from MinIO
         print("Fetching file from MinIO...")
-        file_data = minio_client.get_object(BUCKET_NAME, file_name)
-        file_stream = io.BytesIO(file_data.read())
+        file_stream, file_hash = download_file(file_name)
         print(f"File size: {file_stream.getbuffer().nbytes} bytes")
         
-        # Check if file has changed since last indexing
-        file_hash = get_file_hash(file_stream)
-        processed_files = load_processed_files()
-        
-        if not FORCE_REINDEX and file_name in processed_files and processed_files[file_name]["hash"] == file_hash:
+        # Check if file content has changed since last indexing
+        if not FORCE_REINDEX and previous_record.get("hash") == file_hash:
             print(f"File {file_name} already indexed and unchanged. Skipping.")
-            return
+            # Remember the new etag so the next run can skip the download
+            return {**previous_record, "etag": etag}
         
         # Extract text based on file type
         print("Extracting text...")
@@ -157,7 +306,7 @@ def index_document(file_name):
             }
         else:
             print(f"Unsupported file type: {file_name}")
-            return
+            return None
         
         # Split text into chunks
         print("Chunking text...")
@@ -165,56 +314,63 @@ def index_document(file_name):
         
         if not text_chunks:
             print(f"No text chunks generated from {file_name}")
-            return
+            return None
         
         # Create vector embeddings and store in Qdrant
         print("Generating embeddings and storing in Qdrant...")
-        points = []
-        for i, chunk in enumerate(text_chunks):
-            if i % 50 == 0:
-                print(f"Processing chunk {i}/{len(text_chunks)}")
-                
-            # Generate embedding
-            embedding = embedding_model.encode(chunk).tolist()
-            
-            # Create unique ID for this chunk
-            chunk_id = int(hashlib.md5(f"{file_name}-{i}".encode()).hexdigest()[:16], 16)
-            
-            # Prepare payload
-            payload = {
-                "text": chunk,
-                "metadata": metadata,
-                "chunk_index": i,
-                "total_chunks": len(text_chunks),
-                "indexed_at": time.time()
-            }
-            
-            points.append(PointStruct(id=chunk_id, vector=embedding, payload=payload))
-            
-            # Upload in batches to avoid memory issues
-            if len(points) >= 100:
-                print(f"Uploading batch of {len(points)} points to Qdrant...")
-                qdrant_client.upsert(collection_name=COLLECTION_NAME, points=points)
-                points = []
-        
-        # Upload any remaining points
-        if points:
-            print(f"Uploading final batch of {len(points)} points to Qdrant...")
-            qdrant_client.upsert(collection_name=COLLECTION_NAME, points=points)
-        
-        # Update processed files record
-        processed_files[file_name] = {"hash": file_hash, "last_indexed": time.time()}
-        save_processed_files(processed_files)
+        embeddings = embedding_model.encode(
+            text_chunks,
+            batch_size=EMBEDDING_BATCH_SIZE,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False
+        )
+        print(f"Generated {len(embeddings)} embeddings")
+        
+        print(f"Uploading {len(text_chunks)} points to Qdrant...")
+        # Pass the embedding matrix as-is; the client batches numpy vectors natively.
+        # Upload in-process: files are already indexed concurrently, and most
+        # documents fit in a single batch, so an upload worker pool per file
+        # would only add process and channel startup cost.
+        qdrant_client.upload_collection(
+            collection_name=COLLECTION_NAME,
+            vectors=embeddings,
+            payload=generate_payloads(file_name, text_chunks),
+            ids=(get_chunk_id(file_name, i) for i in range(len(text_chunks))),
+            batch_size=UPLOAD_BATCH_SIZE,
+            max_retries=3,
+            # Points must be applied before the final index version is recorded,
+            # or the retriever could cache partial results under the new version
+            wait=True
+        )
+        
+        # Store document metadata once instead of in every chunk payload
+        qdrant_client.upsert(
+            collection_name=META_COLLECTION_NAME,
+            points=[PointStruct(
+                id=get_doc_id(file_name),
+                vector={},
+                payload={
+                    "metadata": metadata,
+                    "total_chunks": len(text_chunks),
+                    "indexed_at": time.time()
+                }
+            )]
+        )
         
         print(f"Successfully indexed {file_name}: {len(text_chunks)} chunks")
+        return {"hash": file_hash, "etag": etag, "last_indexed": time.time()}
         
     except Exception as e:
         print(f"Error indexing {file_name}: {str(e)}")
         import traceback
         traceback.print_exc()
+        return None
 
 def index_all_documents():
     """Index all documents in the MinIO bucket."""
+    init_clients()
+    
     # Ensure bucket exists
     if not minio_client.bucket_exists(BUCKET_NAME):
         print(f"Bucket '{BUCKET_NAME}' doesn't exist")
@@ -225,14 +381,55 @@ def index_all_documents():
         reset_collection()
     else:
         ensure_collection_exists()
+    update_index_version()
     
     # List and process all objects
     print("Listing objects in bucket...")
     objects = list(minio_client.list_objects(BUCKET_NAME, recursive=True))
     print(f"Found {len(objects)} objects in bucket")
     
-    for obj in objects:
-        index_document(obj.object_name)
+    # Index files in parallel; spawn gives each worker fresh clients and model
+    mp_context = get_context("spawn")
+    file_workers = FILE_WORKERS
+    device_queue = None
+    if torch.cuda.is_available():
+        # One worker per GPU, so each holds a single model copy on its own device
+        gpu_count = torch.cuda.device_count()
+        file_workers = min(file_workers, gpu_count)
+        device_queue = mp_context.Queue()
+        for i in range(file_workers):
+            device_queue.put(f"cuda:{i}")
+    
+    # Split the cores between workers instead of each sizing its thread pools to the machine
+    threads_per_worker = max(1, (os.cpu_count() or 1) // file_workers)
+    
+    processed_files = load_processed_files()
+    try:
+        with ProcessPoolExecutor(
+            max_workers=file_workers,
+            mp_context=mp_context,
+            initializer=init_index_worker,
+            initargs=(device_queue, threads_per_worker)
+        ) as executor:
+            futures = {
+                executor.submit(
+                    index_document,
+                    obj.object_name,
+                    obj.etag,
+                    processed_files.get(obj.object_name)
+                ): obj.object_name
+                for obj in objects
+            }
+            # Only this process updates the processed files record
+            for future in as_completed(futures):
+                record = future.result()
+                if record:
+                    processed_files[futures[future]] = record
+    finally:
+        save_processed_files(processed_files)
+        # Re-enable HNSW indexing even if ingestion failed part way
+        enable_indexing()
+        update_index_version()
     
     # Check final status
     check_collection_status()
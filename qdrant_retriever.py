@@ -2,11 +2,14 @@ from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Dict, Any, Optional
+import asyncio
 import logging
 import time
-from qdrant_client import QdrantClient
+from collections import OrderedDict
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.models import SearchParams, QuantizationSearchParams
 from qdrant_client.http.exceptions import UnexpectedResponse
-from sentence_transformers import SentenceTransformer
+from embeddings import load_embedding_model
 
 # Set up logging
 logging.basicConfig(
@@ -33,9 +36,25 @@ app.add_middleware(
 )
 
 # Initialize Qdrant client and embedding model
-qdrant_client = QdrantClient("localhost", port=6333)
+qdrant_client = AsyncQdrantClient(host="localhost", grpc_port=6334, prefer_grpc=True)
 collection_name = "documents"
-embedding_model = SentenceTransformer("BAAI/bge-base-en-v1.5")
+meta_collection_name = "document_meta"
+index_version_point_id = 0  # Point in meta_collection_name written by each index run
+embedding_model = load_embedding_model()
+
+# LRU cache of query results, keyed on the index version the indexer records
+QUERY_CACHE_SIZE = 1024
+QUERY_CACHE_TTL = 300  # Seconds a cached result may be served
+INDEX_VERSION_TTL = 5  # Seconds between index version lookups
+query_cache = OrderedDict()
+index_version = None
+index_version_checked_at = 0.0
+
+@app.on_event("startup")
+def warm_up_embedding_model():
+    """Run a dummy encode so the first query doesn't pay the warm-up cost."""
+    embedding_model.encode("warmup", normalize_embeddings=True)
+    logger.info("Embedding model warmed up")
 
 # Request and response models
 class QueryRequest(BaseModel):
@@ -70,11 +89,11 @@ def read_root():
     }
 
 @app.get("/health")
-def health_check():
+async def health_check():
     """Endpoint to check the health of the API and its dependencies."""
     try:
         # Check Qdrant connection
-        collections = qdrant_client.get_collections()
+        collections = await qdrant_client.get_collections()
         collection_names = [c.name for c in collections.collections]
         
         # Check if our collection exists
@@ -86,7 +105,7 @@ def health_check():
             }
             
         # Get collection info
-        collection_info = qdrant_client.get_collection(collection_name=collection_name)
+        collection_info = await qdrant_client.get_collection(collection_name=collection_name)
         
         return {
             "status": "healthy",
@@ -107,8 +126,87 @@ def health_check():
             "error": str(e)
         }
 
+async def get_index_version():
+    """Return the version of the last index run, re-reading it at most every few seconds.
+    
+    Returns None if the version is unknown, in which case the cache is skipped.
+    """
+    global index_version, index_version_checked_at
+    now = time.monotonic()
+    if now - index_version_checked_at >= INDEX_VERSION_TTL:
+        index_version_checked_at = now
+        try:
+            records = await qdrant_client.retrieve(
+                collection_name=meta_collection_name,
+                ids=[index_version_point_id],
+                with_payload=True,
+                with_vectors=False
+            )
+            index_version = records[0].payload.get("index_version") if records else None
+        except Exception as e:
+            logger.warning(f"Could not read index version, bypassing query cache: {str(e)}")
+            index_version = None
+    return index_version
+
+async def search_documents(query, limit, threshold):
+    """Embed the query and return matching document chunks as a tuple."""
+    # Generate embedding for the query
+    logger.info(f"Processing query: {query}")
+    # Encode in a thread so the event loop stays responsive
+    loop = asyncio.get_running_loop()
+    query_embedding = await loop.run_in_executor(
+        None,
+        lambda: embedding_model.encode(query, normalize_embeddings=True).tolist()
+    )
+    
+    # Perform vector search in Qdrant
+    search_results = await qdrant_client.search(
+        collection_name=collection_name,
+        query_vector=query_embedding,
+        limit=limit,
+        score_threshold=threshold,
+        # Search the quantized vectors, then rescore candidates at full precision
+        search_params=SearchParams(
+            quantization=QuantizationSearchParams(rescore=True, oversampling=2.0)
+        )
+    )
+    
+    # Fetch document metadata for all hits in one request
+    doc_ids = list({hit.payload["doc_id"] for hit in search_results if "doc_id" in hit.payload})
+    doc_meta = {}
+    if doc_ids:
+        records = await qdrant_client.retrieve(
+            collection_name=meta_collection_name,
+            ids=doc_ids,
+            with_payload=True,
+            with_vectors=False
+        )
+        doc_meta = {record.id: record.payload for record in records}
+    
+    # Process search results
+    documents = []
+    for hit in search_results:
+        try:
+            # Extract metadata
+            doc = doc_meta.get(hit.payload.get("doc_id"), {})
+            metadata = doc.get("metadata", {})
+            
+            document = DocumentChunk(
+                text=hit.payload["text"],
+                file_name=metadata.get("file_name", "Unknown"),
+                score=float(hit.score),  # Convert to float to ensure JSON serialization
+                page_count=metadata.get("page_count"),
+                chunk_index=hit.payload.get("chunk_index"),
+                total_chunks=doc.get("total_chunks")
+            )
+            documents.append(document)
+        except KeyError as e:
+            logger.warning(f"Missing field in search result payload: {e}")
+    
+    return tuple(documents)
+
 @app.post("/retrieve", response_model=QueryResponse)
-def retrieve_docs(request: QueryRequest):
+async def retrieve_docs(request: QueryRequest):
     """
     Retrieve relevant document chunks from the vector database.
     
@@ -123,36 +221,24 @@ def retrieve_docs(request: QueryRequest):
     start_time = time.time()
     
     try:
-        # Generate embedding for the query
-        logger.info(f"Processing query: {request.query}")
-        query_embedding = embedding_model.encode(request.query).tolist()
-        
-        # Perform vector search in Qdrant
-        search_results = qdrant_client.search(
-            collection_name=collection_name,
-            query_vector=query_embedding,
-            limit=request.limit,
-            score_threshold=request.threshold
-        )
-        
-        # Process search results
-        documents = []
-        for hit in search_results:
-            try:
-                # Extract metadata
-                metadata = hit.payload.get("metadata", {})
-                
-                document = DocumentChunk(
-                    text=hit.payload["text"],
-                    file_name=metadata.get("file_name", "Unknown"),
-                    score=float(hit.score),  # Convert to float to ensure JSON serialization
-                    page_count=metadata.get("page_count"),
-                    chunk_index=hit.payload.get("chunk_index"),
-                    total_chunks=hit.payload.get("total_chunks")
-                )
-                documents.append(document)
-            except KeyError as e:
-                logger.warning(f"Missing field in search result payload: {e}")
+        # Serve repeated queries from the cache while the index is unchanged
+        version = await get_index_version()
+        cache_key = (request.query, request.limit, request.threshold, version)
+        cached = query_cache.get(cache_key) if version is not None else None
+        if cached is not None and time.monotonic() - cached[1] < QUERY_CACHE_TTL:
+            documents = cached[0]
+            query_cache.move_to_end(cache_key)
+            logger.info(f"Cache hit for query: {request.query}")
+        else:
+            documents = await search_documents(request.query, request.limit, request.threshold)
+            # Empty results are likely transient, e.g. during a reindex
+            if documents and version is not None:
+                query_cache[cache_key] = (documents, time.monotonic())
+                query_cache.move_to_end(cache_key)
+                if len(query_cache) > QUERY_CACHE_SIZE:
+                    query_cache.popitem(last=False)
+            else:
+                query_cache.pop(cache_key, None)
         
         # Calculate processing time
         took_ms = (time.time() - start_time) * 1000
@@ -160,7 +246,7 @@ def retrieve_docs(request: QueryRequest):
         logger.info(f"Retrieved {len(documents)} documents in {took_ms:.2f}ms")
         
         return QueryResponse(
-            documents=documents,
+            documents=list(documents),
             query=request.query,
             took_ms=took_ms
         )